@@ -1,12 +1,26 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import json
 import os
 import logging
 from datetime import datetime
 import io
+import copy
+import uuid
+from functools import lru_cache
 import altair as alt
-from typing import Dict, Any, List, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+# orjson é opcional: quando instalado, acelera a leitura e a gravação dos JSON
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# st.fragment (Streamlit >= 1.37, experimental_fragment a partir da 1.33) reexecuta
+# apenas a função decorada; em versões anteriores ela roda normalmente.
+fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda func: func)
 
 # Configuração do logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -17,34 +31,159 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(
 FRETE_CONFIG_FILE = "fretes_config.json"
 ORIGENS_CONFIG_FILE = "origens_config.json"
 DATA_FILE = "cost_config.json"
-HISTORY_FILE = "simulation_history.json"
+HISTORY_FILE = "simulation_history.jsonl"
+LEGACY_HISTORY_FILE = "simulation_history.json"
 PRODUCT_FILE = "products.json"
 
+# -----------------------------
+# Opções Fixas da Interface
+# -----------------------------
+MODO_VALOR_TOTAL = "Valor total"
+MODO_UNITARIO = "Unitário × Quantidade"
+MODOS_VALOR_FOB = [MODO_VALOR_TOTAL, MODO_UNITARIO]
+HISTORY_PAGE_SIZES = [20, 50, 100]
+FIELDS_PAGE_SIZE = 25
+# Prefixo das chaves de widget e rótulo de cada imposto no formulário de produtos
+PRODUCT_TAX_FIELDS = {
+    "imposto_importacao": ("ii", "Imposto de Importação (II)"),
+    "ipi": ("ipi", "IPI"),
+    "pis": ("pis", "PIS"),
+    "cofins": ("cofins", "Cofins")
+}
+PRODUCT_TAXES = tuple(PRODUCT_TAX_FIELDS)
+# Configuração inicial de um cenário novo (copiada a cada inclusão), já no formato
+# normalizado: o cenário é usado na mesma execução, sem passar por normalize_cost_config
+DEFAULT_SCENARIO_FIELDS = {
+    "Frete rodoviário": {"type": "fixed", "value": 0.0, "rate_by_occupancy": False},
+    "Marinha Mercante": {
+        "type": "percentage",
+        "rate": 0.08,
+        "base": "Frete Internacional",
+        "rate_by_occupancy": False
+    },
+    "Taxa MAPA": {"type": "fixed", "value": 0.0, "rate_by_occupancy": False},
+    "Taxas Porto Seco": {"type": "fixed", "value": 0.0, "rate_by_occupancy": False},
+    "Desova EAD": {"type": "fixed", "value": 0.0, "rate_by_occupancy": False},
+    "Taxa cross docking": {"type": "fixed", "value": 0.0, "rate_by_occupancy": False},
+    "Taxa DDC": {"type": "fixed", "value": 0.0, "rate_by_occupancy": False}
+}
+# Bases disponíveis para campos percentuais e impostos, e a posição de cada uma no seletor
+BASES = ("Valor CIF", "Valor FOB", "Frete Internacional")
+BASE_INDEX = {base: i for i, base in enumerate(BASES)}
+# Bases informadas em dólar, convertidas para BRL pela taxa de câmbio
+USD_BASES = frozenset(("Valor FOB", "Frete Internacional"))
+
 # -----------------------------
 # Funções Auxiliares e de Persistência com Cache e Tratamento de Erros
 # -----------------------------
+def json_loads(content: bytes) -> Any:
+    """
+    Decodifica JSON usando orjson quando disponível.
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+def json_dumps(data: Any) -> bytes:
+    """
+    Codifica dados em JSON (UTF-8) usando orjson quando disponível.
+    """
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY)
+    # Mesma indentação do orjson (OPT_INDENT_2): o arquivo não muda conforme o ambiente
+    return json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8")
+
+def json_line(record: Any) -> bytes:
+    """
+    Codifica um registro como uma linha JSON compacta (formato JSON Lines).
+    """
+    if orjson is not None:
+        return orjson.dumps(record, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n"
+    return json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+
+def file_mtime(filename: str) -> Union[int, None]:
+    """
+    Retorna o instante da última modificação do arquivo (em ns), ou None se ele não existir.
+    """
+    try:
+        return os.stat(filename).st_mtime_ns
+    except OSError:
+        return None
+
 @st.cache_data(show_spinner=False)
-def load_json_file(filename: str) -> Union[Dict[str, Any], List[Any]]:
+def _load_json_cached(filename: str, mtime: Union[int, None]) -> Union[Dict[str, Any], List[Any]]:
+    """
+    Lê e decodifica um arquivo JSON; o resultado fica em cache por (arquivo, mtime).
+    
+    Args:
+        filename (str): Nome do arquivo JSON.
+        mtime (int | None): Modificação do arquivo, usada apenas como chave do cache.
+    
+    Returns:
+        dict ou list: Conteúdo do arquivo ou {} / [] em caso de erro.
+    """
+    empty = {} if filename != LEGACY_HISTORY_FILE else []
+    if mtime is None:
+        return empty
+    try:
+        with open(filename, "rb") as f:
+            content = f.read().strip()
+            if not content:
+                return empty
+            return json_loads(content)
+    except (json.JSONDecodeError, IOError) as e:
+        logging.error("Erro ao carregar %s: %s", filename, e)
+        return empty
+
+def load_json_file(
+    filename: str,
+    normalize: Optional[Callable[[Any], Any]] = None
+) -> Union[Dict[str, Any], List[Any]]:
     """
     Carrega um arquivo JSON e retorna seu conteúdo.
     
+    Enquanto o arquivo não muda, cada sessão reaproveita o objeto guardado no
+    session_state; só quando o mtime muda ele é buscado de novo no cache global
+    (que devolve uma cópia) ou no disco.
+    
     Args:
         filename (str): Nome do arquivo JSON.
+        normalize (callable, opcional): Ajuste aplicado ao conteúdo uma única vez,
+            quando ele é (re)carregado.
     
     Returns:
         dict ou list: Conteúdo do arquivo ou {} / [] em caso de erro.
     """
-    if os.path.exists(filename):
-        try:
-            with open(filename, "r") as f:
-                content = f.read().strip()
-                if not content:
-                    return {} if filename != HISTORY_FILE else []
-                return json.loads(content)
-        except (json.JSONDecodeError, IOError) as e:
-            logging.error("Erro ao carregar %s: %s", filename, e)
-            return {} if filename != HISTORY_FILE else []
-    return {} if filename != HISTORY_FILE else []
+    mtime = file_mtime(filename)
+    session_key = f"_json_{filename}"
+    cached = st.session_state.get(session_key)
+    if cached is None or cached[0] != mtime:
+        content = _load_json_cached(filename, mtime)
+        if normalize is not None:
+            content = normalize(content)
+        cached = (mtime, content)
+        st.session_state[session_key] = cached
+    return cached[1]
+
+def write_file_atomic(filename: str, content: bytes) -> None:
+    """
+    Grava o conteúdo em um arquivo temporário e o move sobre o destino.
+    
+    O os.replace é atômico: um rerun que leia o arquivo durante a gravação vê a
+    versão anterior completa ou a nova, nunca um JSON truncado.
+    
+    Args:
+        filename (str): Arquivo de destino.
+        content (bytes): Conteúdo completo do arquivo.
+    """
+    tmp_file = filename + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(content)
+        # O conteúdo precisa estar no disco antes da troca, senão uma queda de energia
+        # pode deixar o nome apontando para um arquivo vazio
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, filename)
 
 def save_json_file(data: Any, filename: str) -> None:
     """
@@ -55,10 +194,43 @@ def save_json_file(data: Any, filename: str) -> None:
         filename (str): Nome do arquivo JSON.
     """
     try:
-        with open(filename, "w") as f:
-            json.dump(data, f, indent=4)
+        write_file_atomic(filename, json_dumps(data))
     except IOError as e:
         logging.error("Erro ao salvar %s: %s", filename, e)
+    # Garante a releitura mesmo em sistemas de arquivos com mtime de baixa resolução
+    _load_json_cached.clear()
+    names_frame.clear()
+    origens_frame.clear()
+    st.session_state.pop(f"_json_{filename}", None)
+
+# Só a versão atual do arquivo é lida: versões anteriores não ficam em memória
+@st.cache_data(show_spinner=False, max_entries=1)
+def load_jsonl_file(filename: str, file_size: int, mtime: int) -> List[Any]:
+    """
+    Carrega um arquivo JSON Lines, com um registro por linha.
+    
+    Args:
+        filename (str): Nome do arquivo JSONL.
+        file_size (int): Tamanho atual do arquivo, usado apenas para invalidar o cache.
+        mtime (int): Modificação do arquivo, usada apenas para invalidar o cache.
+    
+    Returns:
+        list: Registros válidos do arquivo (linhas corrompidas são ignoradas).
+    """
+    records = []
+    try:
+        with open(filename, "rb") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json_loads(line))
+                except json.JSONDecodeError as e:
+                    logging.error("Linha inválida em %s: %s", filename, e)
+    except IOError as e:
+        logging.error("Erro ao carregar %s: %s", filename, e)
+    return records
 
 # Funções específicas para cada arquivo
 def load_frete_config() -> Dict[str, Any]:
@@ -73,80 +245,454 @@ def load_origens_config() -> Dict[str, Any]:
 def save_origens_config(config: Dict[str, Any]) -> None:
     save_json_file(config, ORIGENS_CONFIG_FILE)
 
+def normalize_cost_config(config: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Converte todos os campos de custo para o formato de dicionário completo.
+    
+    Campos antigos gravados só como número viram campos fixos, e chaves ausentes
+    recebem os valores padrão. O formato normalizado é persistido no próximo save.
+    
+    Args:
+        config (dict): Configuração de filiais, cenários e campos.
+    
+    Returns:
+        dict: A mesma configuração, normalizada.
+    """
+    for scenarios in config.values():
+        for fields in scenarios.values():
+            for field, conf in fields.items():
+                if not isinstance(conf, dict):
+                    try:
+                        value = float(conf)
+                    except (TypeError, ValueError):
+                        # Um valor antigo inválido não pode impedir a carga da configuração inteira
+                        logging.error("Valor inválido no campo %s: %r (considerado 0)", field, conf)
+                        value = 0.0
+                    fields[field] = {"type": "fixed", "value": value, "rate_by_occupancy": False}
+                    continue
+                conf.setdefault("type", "fixed")
+                conf.setdefault("rate_by_occupancy", False)
+                if conf["type"] == "fixed":
+                    conf.setdefault("value", 0.0)
+                elif conf["type"] == "percentage":
+                    conf.setdefault("rate", 0.0)
+                    conf.setdefault("base", "Valor CIF")
+    return config
+
 def load_data() -> Dict[str, Any]:
-    return load_json_file(DATA_FILE)
+    return load_json_file(DATA_FILE, normalize_cost_config)
 
 def save_data(data: Dict[str, Any]) -> None:
     save_json_file(data, DATA_FILE)
 
+def mutate_and_save(
+    content: Dict[str, Any],
+    mutate: Callable[[], bool],
+    save: Callable[[Dict[str, Any]], None] = save_data
+) -> bool:
+    """
+    Aplica uma alteração em memória e grava o arquivo uma única vez, só se algo mudou.
+    
+    Caminho comum das inclusões e exclusões do Gerenciamento.
+    
+    Args:
+        content (dict): Conteúdo completo do arquivo (configuração, produtos ou origens).
+        mutate (callable): Altera o conteúdo e retorna True se houve mudança.
+        save (callable): Função que grava o conteúdo (padrão: save_data).
+    
+    Returns:
+        bool: True se houve alteração (e gravação).
+    """
+    if not mutate():
+        return False
+    save(content)
+    return True
+
+def add_config_entry(config: Dict[str, Any], container: Dict[str, Any], name: str, value: Any) -> bool:
+    """
+    Insere um item (filial, cenário ou campo) na configuração e grava o arquivo.
+    
+    A verificação de existência e a inserção são feitas numa única consulta ao
+    dicionário; nada é gravado se o nome já existir.
+    
+    Args:
+        config (dict): Configuração completa, gravada em disco.
+        container (dict): Dicionário onde o item será inserido.
+        name (str): Nome do novo item.
+        value (Any): Conteúdo inicial do item.
+    
+    Returns:
+        bool: True se o item foi inserido, False se já existia.
+    """
+    return mutate_and_save(config, lambda: container.setdefault(name, value) is value)
+
+def ensure_history_ids(history: List[Any]) -> List[Any]:
+    """
+    Completa o "id" dos registros gravados antes de o histórico ter identificadores.
+    
+    O id derivado da posição no arquivo é estável: novos registros entram no fim do
+    arquivo e já trazem o próprio id, e qualquer regravação persiste os ids atuais.
+    
+    Args:
+        history (list): Registros na ordem do arquivo.
+    
+    Returns:
+        list: Os mesmos registros, todos com "id".
+    """
+    for position, record in enumerate(history):
+        record.setdefault("id", f"legado-{position}")
+    return history
+
 def load_history() -> List[Any]:
-    return load_json_file(HISTORY_FILE)
+    try:
+        stat = os.stat(HISTORY_FILE)
+    except OSError:
+        # Histórico ainda no formato antigo (lista JSON única)
+        return ensure_history_ids(load_json_file(LEGACY_HISTORY_FILE))
+    # Tamanho e mtime juntos: uma exclusão pode regravar o arquivo com o mesmo tamanho
+    return ensure_history_ids(load_jsonl_file(HISTORY_FILE, stat.st_size, stat.st_mtime_ns))
+
+@st.cache_data(show_spinner=False, max_entries=1)
+def _sort_history_file(file_size: int, mtime: int) -> List[Any]:
+    """
+    Registros do histórico JSONL do mais recente para o mais antigo, em cache por versão do arquivo.
+    """
+    # O timestamp "%Y-%m-%d %H:%M:%S" ordena como texto na mesma ordem cronológica
+    history = ensure_history_ids(load_jsonl_file(HISTORY_FILE, file_size, mtime))
+    return sorted(history, key=lambda r: r["timestamp"], reverse=True)
+
+def load_sorted_history() -> List[Any]:
+    """
+    Carrega o histórico já ordenado do mais recente para o mais antigo.
+    
+    A ordenação é feita uma vez por versão do arquivo, e não a cada rerun da tela
+    de histórico.
+    """
+    try:
+        stat = os.stat(HISTORY_FILE)
+    except OSError:
+        return sorted(load_history(), key=lambda r: r["timestamp"], reverse=True)
+    return _sort_history_file(stat.st_size, stat.st_mtime_ns)
 
 def save_history(history: List[Any]) -> None:
-    save_json_file(history, HISTORY_FILE)
+    """
+    Regrava o histórico completo (usado apenas em exclusões).
+    """
+    try:
+        write_file_atomic(HISTORY_FILE, b"".join(json_line(record) for record in history))
+    except IOError as e:
+        logging.error("Erro ao salvar %s: %s", HISTORY_FILE, e)
+
+@st.cache_data(show_spinner=False, max_entries=1)
+def read_file_bytes(filename: str, file_size: int, mtime: int) -> bytes:
+    """
+    Conteúdo bruto de um arquivo, em cache por (tamanho, mtime) como os carregadores.
+    """
+    with open(filename, "rb") as f:
+        return f.read()
+
+def clamp_history_page(total_records: int) -> None:
+    """
+    Mantém a página do histórico dentro do total de páginas.
+    
+    Usado após exclusões e na troca do tamanho de página, quando a página guardada
+    no session_state pode deixar de existir.
+    
+    Args:
+        total_records (int): Quantidade de registros no histórico.
+    """
+    page_size = st.session_state.get("history_page_size", HISTORY_PAGE_SIZES[0])
+    page_count = max(1, (total_records + page_size - 1) // page_size)
+    if st.session_state.get("history_page", 1) > page_count:
+        st.session_state["history_page"] = page_count
+
+def delete_history_record(record_id: str) -> None:
+    """
+    Remove um registro do histórico (callback do botão de exclusão).
+    
+    Executado antes do rerun: a página já é montada sem o registro excluído. O
+    registro é identificado pelo id, e não pela posição (que muda se outra sessão
+    gravar no histórico) nem pelo timestamp (que só tem resolução de segundos).
+    
+    Args:
+        record_id (str): Id do registro a excluir.
+    """
+    # Filtra a lista na ordem do arquivo, para que a regravação mantenha a ordem
+    # cronológica em que append_history acrescenta os registros
+    history = load_history()
+    remaining = [record for record in history if record["id"] != record_id]
+    if len(remaining) != len(history):
+        save_history(remaining)
+        clamp_history_page(len(remaining))
+        st.session_state["_history_deleted"] = True
+
+def append_history(record: Dict[str, Any]) -> None:
+    """
+    Acrescenta um registro ao final do histórico sem regravar os anteriores.
+    """
+    record["id"] = uuid.uuid4().hex
+    if not os.path.exists(HISTORY_FILE) and os.path.exists(LEGACY_HISTORY_FILE):
+        # Primeira gravação após a migração: converte o histórico antigo
+        save_history(load_history() + [record])
+        return
+    try:
+        with open(HISTORY_FILE, "ab") as f:
+            f.write(json_line(record))
+    except IOError as e:
+        logging.error("Erro ao salvar %s: %s", HISTORY_FILE, e)
+
+def normalize_products(products: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Garante que todo produto tenha descrição e alíquota/base para cada imposto.
+    
+    Impostos ausentes entram com alíquota zero sobre o Valor CIF, de modo que a
+    listagem acessa os campos diretamente, sem cadeias de `.get`.
+    
+    Args:
+        products (dict): Produtos cadastrados, indexados pelo NCM.
+    
+    Returns:
+        dict: Os mesmos produtos, normalizados.
+    """
+    for prod in products.values():
+        prod.setdefault("descricao", "")
+        for tax in PRODUCT_TAXES:
+            tax_info = prod.get(tax)
+            if not tax_info:
+                prod[tax] = {"rate": 0.0, "base": "Valor CIF"}
+                continue
+            tax_info.setdefault("rate", 0.0)
+            tax_info.setdefault("base", "Valor CIF")
+    return products
 
 def load_products() -> Dict[str, Any]:
-    return load_json_file(PRODUCT_FILE)
+    return load_json_file(PRODUCT_FILE, normalize_products)
 
 def save_products(products: Dict[str, Any]) -> None:
     save_json_file(products, PRODUCT_FILE)
 
+@st.cache_data(show_spinner=False)
+def names_frame(filename: str, mtime: Union[int, None], column: str, parent: Optional[str] = None) -> pd.DataFrame:
+    """
+    Tabela de uma coluna com as chaves de um arquivo de configuração (ou de um item dele).
+    
+    Fica em cache por versão do arquivo: reruns causados por outros widgets não
+    reconstroem a tabela.
+    
+    Args:
+        filename (str): Arquivo de configuração.
+        mtime (int | None): Modificação do arquivo, usada apenas como chave do cache.
+        column (str): Título da coluna.
+        parent (str, opcional): Item cujas chaves serão listadas (ex.: a filial).
+    
+    Returns:
+        pd.DataFrame: Tabela com os nomes, na ordem do arquivo.
+    """
+    content = _load_json_cached(filename, mtime)
+    if parent is not None:
+        content = content.get(parent, {})
+    return pd.DataFrame({column: list(content)})
+
+@st.cache_data(show_spinner=False)
+def origens_frame(mtime: Union[int, None]) -> pd.DataFrame:
+    """
+    Tabela das origens com fretes e taxas, em cache por versão do arquivo.
+    """
+    origens_df = pd.DataFrame.from_dict(_load_json_cached(ORIGENS_CONFIG_FILE, mtime), orient="index")
+    return origens_df.rename(columns={"frete_internacional_usd": "Frete Internacional (USD)",
+                                      "taxas_frete_brl": "Taxas de Frete (BRL)"})
+
+def queue_delete(target: str, path: Tuple[str, ...], message: str) -> None:
+    """
+    Agenda uma exclusão para o início do próximo rerun (callback dos botões Excluir).
+    
+    Args:
+        target (str): Arquivo afetado: "config", "produtos" ou "origens".
+        path (tuple): Chaves até o item a excluir, a última sendo o próprio item.
+        message (str): Mensagem exibida após a exclusão.
+    """
+    st.session_state.setdefault("_pending_deletes", []).append((target, path, message))
+
+def apply_pending_deletes(config_data: Dict[str, Any], products: Dict[str, Any]) -> List[str]:
+    """
+    Aplica de uma vez as exclusões agendadas e grava cada arquivo afetado uma única vez.
+    
+    As exclusões de cada arquivo passam por mutate_and_save, o mesmo caminho das inclusões.
+    
+    Chamada antes de a página ser montada, de modo que a tela já reflete as
+    exclusões sem precisar de um rerun adicional.
+    
+    Args:
+        config_data (dict): Configuração de filiais e cenários.
+        products (dict): Produtos cadastrados.
+    
+    Returns:
+        list: Mensagens das exclusões efetivamente aplicadas.
+    """
+    pending = st.session_state.pop("_pending_deletes", None)
+    if not pending:
+        return []
+    targets = {"config": (config_data, save_data), "produtos": (products, save_products)}
+    if any(target == "origens" for target, _, _ in pending):
+        targets["origens"] = (load_origens_config(), save_origens_config)
+    queued: Dict[str, List[Tuple[Tuple[str, ...], str]]] = {}
+    for target, path, message in pending:
+        queued.setdefault(target, []).append((path, message))
+    messages = []
+    for target, deletes in queued.items():
+        content, save = targets[target]
+
+        def delete_queued(content=content, deletes=deletes) -> bool:
+            removed = False
+            for path, message in deletes:
+                container = content
+                for key in path[:-1]:
+                    container = container.get(key, {})
+                if container.pop(path[-1], None) is not None:
+                    removed = True
+                    messages.append(message)
+            return removed
+
+        mutate_and_save(content, delete_queued, save)
+    return messages
+
 # -----------------------------
 # Funções de Cálculo de Custos e Impostos
 # -----------------------------
+# Troca "," <-> "." da formatação americana para o padrão brasileiro em uma passada
+BRL_SEPARATORS = str.maketrans(",.", ".,")
+
+@lru_cache(maxsize=4096)
+def _format_brl_cached(value: float) -> str:
+    """
+    Formatação BRL memorizada: os mesmos valores (custos do histórico, melhor
+    custo) são formatados de novo a cada rerun.
+    """
+    return f"{value:,.2f}".translate(BRL_SEPARATORS)
+
 def format_brl(value: Union[float, int]) -> str:
     """
     Formata um número para o padrão monetário BRL.
+    
+    A conversão para float fica fora do cache, de modo que valores inválidos
+    (inclusive não hashable) caem no tratamento de erro em vez de no lru_cache.
     """
     try:
-        s = "{:,.2f}".format(float(value))
-        s = s.replace(",", "TEMP").replace(".", ",").replace("TEMP", ".")
-        return s
+        return _format_brl_cached(float(value))
     except Exception as e:
         logging.error("Erro na formatação do valor: %s", e)
         return str(value)
 
-def calculate_total_cost_extended(
-    config: Dict[str, Any],
-    base_values: Dict[str, float],
-    exchange_rate: float,
-    occupancy_fraction: float
-) -> float:
+def format_brl_frame(df: pd.DataFrame) -> pd.DataFrame:
     """
-    Calcula o custo total de um cenário de importação, somando valores fixos e percentuais.
+    Formata as colunas numéricas de um DataFrame no padrão monetário BRL.
+    
+    A formatação é feita coluna a coluna: os números passam por um único format
+    e a troca de separadores é feita com str.translate vetorizado, em vez de
+    chamar format_brl célula a célula.
+    
+    Args:
+        df (pd.DataFrame): Tabela de resultados.
+    
+    Returns:
+        pd.DataFrame: Cópia da tabela com as colunas numéricas como texto.
+    """
+    df_formatted = df.copy()
+    for column in df.select_dtypes(include="number").columns:
+        df_formatted[column] = df[column].map("{:,.2f}".format).str.translate(BRL_SEPARATORS)
+    return df_formatted
+
+def convert_base_values(base_values: Dict[str, float], exchange_rate: float) -> Dict[str, float]:
+    """
+    Converte para BRL as bases cotadas em dólar ("Valor FOB" e "Frete Internacional").
     
     Args:
-        config (dict): Configuração dos campos do cenário.
         base_values (dict): Valores base para os cálculos.
         exchange_rate (float): Taxa de câmbio (USD -> BRL).
-        occupancy_fraction (float): Fração de ocupação do container (0 a 1).
     
     Returns:
-        float: Custo total calculado.
+        dict: Valores base em BRL, prontos para aplicar as alíquotas percentuais.
     """
-    extra_cost = 0.0
-    for field, conf in config.items():
-        if not isinstance(conf, dict):
-            cost_value = conf
-        else:
-            field_type = conf.get("type", "fixed")
-            rate_by_occupancy = conf.get("rate_by_occupancy", False)
-            if field_type == "fixed":
-                cost_value = conf.get("value", 0)
-            elif field_type == "percentage":
-                base = conf.get("base", "")
-                rate = conf.get("rate", 0)
-                base_val = base_values.get(base, 0)
-                # Se a base for "Valor FOB" ou "Frete Internacional", aplica o câmbio
-                if base.strip().lower() in ["valor fob", "frete internacional"]:
-                    base_val *= exchange_rate
-                cost_value = base_val * rate
+    return {
+        base: value * exchange_rate if base in USD_BASES else value
+        for base, value in base_values.items()
+    }
+
+@st.cache_data(show_spinner=False)
+def build_field_table(scenarios: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Organiza os campos de todos os cenários de uma filial em arrays contíguos.
+    
+    Cada campo ocupa uma posição dos arrays (valor fixo ou alíquota, base e rateio
+    por ocupação), com os campos de um mesmo cenário em sequência. Assim o custo de
+    todos os cenários sai de poucas operações NumPy, sem laço por campo. O cenário
+    "teste" e cenários sem campos ficam de fora.
+    
+    Args:
+        scenarios (dict): Cenários de uma filial e a configuração de seus campos.
+    
+    Returns:
+        dict: Nomes dos cenários e de seus campos, início de cada cenário nos
+            arrays, valores, índice da base, nomes das bases e máscara de rateio.
+    """
+    scenario_names, field_names, starts = [], [], []
+    values, base_idx, by_occupancy = [], [], []
+    base_names = {}
+    for scenario, conf in scenarios.items():
+        if scenario.lower() == "teste" or not conf:
+            continue
+        scenario_names.append(scenario)
+        field_names.append(list(conf))
+        starts.append(len(values))
+        for field_conf in conf.values():
+            if not isinstance(field_conf, dict):
+                # Formato antigo: valor fixo, sem rateio
+                values.append(field_conf)
+                base_idx.append(-1)
+                by_occupancy.append(False)
+                continue
+            field_type = field_conf.get("type", "fixed")
+            if field_type == "percentage":
+                values.append(field_conf.get("rate", 0))
+                base_idx.append(base_names.setdefault(field_conf.get("base", ""), len(base_names)))
             else:
-                cost_value = 0
-            if rate_by_occupancy:
-                cost_value *= occupancy_fraction
-        extra_cost += cost_value
-    return base_values.get("Valor CIF", 0) + extra_cost
+                values.append(field_conf.get("value", 0) if field_type == "fixed" else 0)
+                base_idx.append(-1)
+            by_occupancy.append(bool(field_conf.get("rate_by_occupancy", False)))
+    return {
+        "scenarios": scenario_names,
+        "fields": field_names,
+        "starts": np.array(starts, dtype=np.intp),
+        "values": np.array(values, dtype=np.float64),
+        "base_idx": np.array(base_idx, dtype=np.intp),
+        "base_names": list(base_names),
+        "by_occupancy": np.array(by_occupancy, dtype=bool)
+    }
+
+def evaluate_field_table(
+    table: Dict[str, Any],
+    converted_bases: Dict[str, float],
+    occupancy_fraction: float
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Calcula de uma vez o valor de todos os campos e o custo extra de cada cenário.
+    
+    Args:
+        table (dict): Tabela de campos montada por build_field_table (com ao menos um cenário).
+        converted_bases (dict): Valores base já convertidos para BRL.
+        occupancy_fraction (float): Fração de ocupação do container (0 a 1).
+    
+    Returns:
+        tuple: (valor de cada campo, se o cenário tem algum valor positivo antes
+            do rateio, soma dos campos de cada cenário).
+    """
+    # A última posição (1.0) atende os campos fixos, que apontam para o índice -1
+    bases = np.array([converted_bases.get(base, 0) for base in table["base_names"]] + [1.0], dtype=np.float64)
+    raw_values = table["values"] * bases[table["base_idx"]]
+    field_values = np.where(table["by_occupancy"], raw_values * occupancy_fraction, raw_values)
+    has_value = np.logical_or.reduceat(raw_values > 0, table["starts"])
+    extra_costs = np.add.reduceat(field_values, table["starts"])
+    return field_values, has_value, extra_costs
 
 def calculate_product_taxes(
     product: Dict[str, Any],
@@ -166,15 +712,11 @@ def calculate_product_taxes(
     Returns:
         dict: Dicionário com os impostos calculados.
     """
-    taxes = {}
-    for tax in ["imposto_importacao", "ipi", "pis", "cofins"]:
+    taxes = dict.fromkeys(PRODUCT_TAXES, 0.0)
+    for tax in PRODUCT_TAXES:
         tax_info = product.get(tax)
         if tax_info:
-            base_name = tax_info.get("base", "")
-            base_val = base_values.get(base_name, 0)
-            taxes[tax] = base_val * tax_info.get("rate", 0)
-        else:
-            taxes[tax] = 0.0
+            taxes[tax] = base_values.get(tax_info.get("base", ""), 0) * tax_info.get("rate", 0)
     return taxes
 
 # -----------------------------
@@ -191,8 +733,8 @@ def generate_csv(simulation_record: Dict[str, Any]) -> bytes:
         bytes: Dados CSV codificados em UTF-8.
     """
     results = simulation_record.get("results", {})
-    df = pd.DataFrame(results).T
-    df_formatted = df.applymap(lambda x: format_brl(x) if isinstance(x, (int, float)) else x)
+    df = pd.DataFrame.from_dict(results, orient="index")
+    df_formatted = format_brl_frame(df)
     csv_data = df_formatted.to_csv(index=True, sep=";")
     return csv_data.encode("utf-8")
 
@@ -203,7 +745,7 @@ def compute_simulation_costs(
     config_data: Dict[str, Any],
     filial: str,
     base_values: Dict[str, float],
-    exchange_rate: float,
+    converted_bases: Dict[str, float],
     occupancy_fraction: float,
     additional_freight: float,
     product_tax_values: Dict[str, float]
@@ -215,7 +757,7 @@ def compute_simulation_costs(
         config_data (dict): Dados de configuração de cenários para a filial.
         filial (str): Nome da filial.
         base_values (dict): Valores base para o cálculo.
-        exchange_rate (float): Taxa de câmbio.
+        converted_bases (dict): Valores base já convertidos para BRL (convert_base_values).
         occupancy_fraction (float): Fração de ocupação do container.
         additional_freight (float): Taxas de frete (BRL) rateadas.
         product_tax_values (dict): Impostos do produto.
@@ -223,67 +765,420 @@ def compute_simulation_costs(
     Returns:
         dict: Custos calculados para cada cenário.
     """
+    # Valores que não dependem do cenário são resolvidos uma única vez
+    valor_fob = base_values.get("Valor FOB", 0)
+    frete_internacional = base_values.get("Frete Internacional", 0)
+    valor_cif = base_values.get("Valor CIF", 0)
+    quantidade = base_values.get("Quantidade", 1)
+    shared_costs = additional_freight + sum(product_tax_values.values())
+
+    table = build_field_table(config_data.get(filial, {}))
+    if not table["scenarios"]:
+        return {}
+    # Todos os campos de todos os cenários avaliados de uma vez
+    field_values, has_value, extra_costs = evaluate_field_table(table, converted_bases, occupancy_fraction)
+
     costs = {}
-    for scenario, conf in config_data.get(filial, {}).items():
-        if scenario.lower() == "teste":
+    for i, scenario in enumerate(table["scenarios"]):
+        # Cenários sem nenhum valor configurado ficam de fora da comparação
+        if not has_value[i]:
             continue
-        tem_valor = False
-        # Verifica se existe algum valor configurado para o cenário
-        for field, field_conf in conf.items():
-            if isinstance(field_conf, dict):
-                if field_conf.get("type", "fixed") == "fixed" and field_conf.get("value", 0) > 0:
-                    tem_valor = True
-                elif field_conf.get("type", "percentage") == "percentage":
-                    base_name = field_conf.get("base", "")
-                    base_val = base_values.get(base_name, 0)
-                    if base_name.strip().lower() in ["valor fob", "frete internacional"]:
-                        base_val *= exchange_rate
-                    if base_val * field_conf.get("rate", 0) > 0:
-                        tem_valor = True
-            elif field_conf > 0:
-                tem_valor = True
-        if not tem_valor:
-            continue
-
-        scenario_cost = calculate_total_cost_extended(conf, base_values, exchange_rate, occupancy_fraction)
-        base_cost = scenario_cost + additional_freight
-        final_cost = base_cost + sum(product_tax_values.values())
+        final_cost = valor_cif + float(extra_costs[i]) + shared_costs
         scenario_result = {
-            "Valor FOB": base_values.get("Valor FOB", 0),
-            "Frete internacional": base_values.get("Frete Internacional", 0),
-            "Valor CIF com seguro": base_values.get("Valor CIF", 0),
+            "Valor FOB": valor_fob,
+            "Frete internacional": frete_internacional,
+            "Valor CIF com seguro": valor_cif,
             "Custo final": final_cost
         }
-        if base_values.get("Quantidade", 1) > 0:
-            scenario_result["Custo Unitário Final"] = final_cost / base_values.get("Quantidade", 1)
+        if quantidade > 0:
+            scenario_result["Custo Unitário Final"] = final_cost / quantidade
 
         # Adiciona os custos de cada campo
-        for field, field_conf in conf.items():
-            if isinstance(field_conf, dict):
-                field_type = field_conf.get("type", "fixed")
-                rate_by_occ = field_conf.get("rate_by_occupancy", False)
-                base_name = field_conf.get("base", "")
-                if field_type == "fixed":
-                    field_val = field_conf.get("value", 0)
-                elif field_type == "percentage":
-                    rate = field_conf.get("rate", 0)
-                    base_val = base_values.get(base_name, 0)
-                    if base_name.strip().lower() in ["valor fob", "frete internacional"]:
-                        base_val *= exchange_rate
-                    field_val = base_val * rate
-                else:
-                    field_val = 0
-                if rate_by_occ:
-                    field_val *= occupancy_fraction
-                scenario_result[field] = field_val
-            else:
-                scenario_result[field] = field_conf
+        fields = table["fields"][i]
+        start = table["starts"][i]
+        scenario_result.update(zip(fields, field_values[start:start + len(fields)].tolist()))
 
         scenario_result["Taxas frete (BRL) rateadas"] = additional_freight
         costs[scenario] = scenario_result
 
     return costs
 
+# -----------------------------
+# Formulário e Cálculo Comuns aos Modos de Simulação
+# -----------------------------
+def render_simulation_form(multi: bool) -> Tuple[bool, Dict[str, Any], Dict[str, float]]:
+    """
+    Desenha o formulário de parâmetros da simulação, comum aos dois modos.
+    
+    Args:
+        multi (bool): True para a comparação multifilial (usa chaves de widget próprias).
+    
+    Returns:
+        tuple: (formulário enviado, parâmetros informados, valores base para os cálculos).
+    """
+    suffix = "_multi" if multi else ""
+    with st.form("form_simulacao_multi" if multi else "form_simulacao_unica"):
+        modo_valor_fob = st.selectbox("Como deseja informar o Valor FOB?", MODOS_VALOR_FOB, key="modo_valor_fob" + suffix)
+        col1, col2 = st.columns(2)
+        if modo_valor_fob == MODO_VALOR_TOTAL:
+            with col1:
+                valor_fob_usd = st.number_input("Valor FOB da mercadoria (USD)", min_value=0.0, value=0.0, key="valor_fob_usd" + suffix)
+                quantidade = 1.0
+                valor_unit_fob_usd = 0.0
+            with col2:
+                st.write("Usando frete internacional configurado via origem")
+        else:
+            with col1:
+                valor_unit_fob_usd = st.number_input("Valor unitário FOB (USD/unidade)", min_value=0.0, value=0.0, key="valor_unit_fob_usd" + suffix)
+                quantidade = st.number_input("Quantidade", min_value=0.0, value=0.0, key="quantidade" + suffix)
+                valor_fob_usd = valor_unit_fob_usd * quantidade
+            with col2:
+                st.write(f"Valor FOB (USD) calculado: **{valor_fob_usd:,.2f}**")
+        
+        origens_config = load_origens_config()
+        if origens_config:
+            origem_selecionada = st.selectbox("Selecione a origem do material", list(origens_config), key="origem_selecionada" + suffix)
+            frete_internacional_usd = origens_config[origem_selecionada]["frete_internacional_usd"]
+            taxas_frete_brl = origens_config[origem_selecionada]["taxas_frete_brl"]
+        else:
+            st.info("Nenhuma origem configurada. Por favor, solicite ao administrador.")
+            frete_internacional_usd = 0.0
+            taxas_frete_brl = 0.0
+        
+        percentual_ocupacao = st.number_input("Percentual de ocupação do contêiner (%)", min_value=0.0, max_value=100.0, value=100.0, key="percentual_ocupacao" + suffix)
+        occupancy_fraction = percentual_ocupacao / 100.0
+        frete_internacional_rateado = frete_internacional_usd * occupancy_fraction
+        taxas_frete_rateada = taxas_frete_brl * occupancy_fraction
+        taxa_cambio = st.number_input("Taxa de Câmbio (USD -> BRL)", min_value=0.0, value=5.0, key="taxa_cambio" + suffix)
+        valor_cif_base = (valor_fob_usd + frete_internacional_rateado) * taxa_cambio
+        seguro = 0.0015 * (valor_fob_usd * taxa_cambio)
+        valor_cif = valor_cif_base + seguro
+        base_values = {
+            "Valor CIF": valor_cif,
+            "Valor FOB": valor_fob_usd,
+            "Frete Internacional": frete_internacional_rateado,
+            "Quantidade": quantidade
+        }
+        submitted = st.form_submit_button("Calcular Comparação" if multi else "Calcular Simulação")
+    
+    form_inputs = {
+        "modo_valor_fob": modo_valor_fob,
+        "valor_unit_fob_usd": valor_unit_fob_usd,
+        "quantidade": float(quantidade),
+        "valor_fob_usd": valor_fob_usd,
+        "frete_internacional_usd": frete_internacional_usd,
+        "percentual_ocupacao": percentual_ocupacao,
+        "frete_internacional_rateado": frete_internacional_rateado,
+        "taxas_frete_brl": taxas_frete_brl,
+        "taxas_frete_rateada": taxas_frete_rateada,
+        "taxa_cambio": taxa_cambio,
+        "seguro": float(seguro),
+        "valor_cif": valor_cif
+    }
+    return submitted, form_inputs, base_values
+
+# Cada simulação distinta é uma entrada: só as mais recentes ficam guardadas
+@st.cache_data(show_spinner=False, max_entries=32)
+def compute_filiais_costs(
+    config_data: Dict[str, Any],
+    filiais: List[str],
+    base_values: Dict[str, float],
+    taxa_cambio: float,
+    occupancy_fraction: float,
+    taxas_frete_rateada: float,
+    product: Union[Dict[str, Any], None]
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Calcula os custos dos cenários de uma ou mais filiais com os mesmos parâmetros.
+    
+    O resultado fica em cache pelos próprios argumentos: reenviar o formulário com
+    a mesma configuração e os mesmos valores não refaz os cálculos. Só entram os
+    parâmetros que afetam o custo (o nome do processo, por exemplo, fica de fora).
+    
+    Args:
+        config_data (dict): Dados de configuração de cenários por filial.
+        filiais (list): Filiais a simular.
+        base_values (dict): Valores base para o cálculo.
+        taxa_cambio (float): Taxa de câmbio (USD -> BRL).
+        occupancy_fraction (float): Fração de ocupação do container (0 a 1).
+        taxas_frete_rateada (float): Taxas de frete (BRL) rateadas.
+        product (dict | None): Produto selecionado, se houver.
+    
+    Returns:
+        dict: Custos por cenário, agrupados por filial.
+    """
+    if product:
+        product_taxes = calculate_product_taxes(product, base_values, taxa_cambio, occupancy_fraction)
+    else:
+        product_taxes = dict.fromkeys(PRODUCT_TAXES, 0.0)
+    # As bases em dólar são convertidas uma única vez para todas as filiais
+    converted_bases = convert_base_values(base_values, taxa_cambio)
+    return {
+        filial: compute_simulation_costs(config_data, filial, base_values, converted_bases, occupancy_fraction,
+                                         taxas_frete_rateada, product_taxes)
+        for filial in filiais if filial in config_data
+    }
+
+# -----------------------------
+# Exibição dos Resultados da Simulação
+# -----------------------------
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_cost_chart(cenarios: Tuple[str, ...], custos: Tuple[float, ...]) -> Dict[str, Any]:
+    """
+    Monta a especificação Vega-Lite do gráfico de barras do custo final por cenário.
+    
+    A especificação já serializada fica em cache por conjunto de cenários e custos,
+    e só as duas colunas exibidas entram nela.
+    
+    Args:
+        cenarios (tuple): Nomes dos cenários, já na ordem de exibição.
+        custos (tuple): Custo final de cada cenário.
+    
+    Returns:
+        dict: Especificação Vega-Lite do gráfico de comparação de custos.
+    """
+    chart_data = pd.DataFrame({"Cenário": cenarios, "Custo final": custos})
+    return alt.Chart(chart_data).mark_bar().encode(
+        x=alt.X("Cenário:N", sort=None),
+        y=alt.Y("Custo final:Q", title="Custo Final (BRL)"),
+        tooltip=["Cenário", "Custo final"]
+    ).properties(title="Comparação de Custos por Cenário").to_dict()
+
+@fragment
+def render_single_results(costs: Dict[str, Any], filial_selected: str, simulation_inputs: Dict[str, Any]) -> None:
+    """
+    Exibe a comparação de cenários de uma filial e permite salvá-la no histórico.
+    
+    Como fragmento, o clique em "Salvar" reexecuta apenas este trecho, reaproveitando
+    os custos já calculados em vez de reprocessar a página inteira.
+    
+    Args:
+        costs (dict): Custos calculados por cenário.
+        filial_selected (str): Nome da filial simulada.
+        simulation_inputs (dict): Parâmetros da simulação a registrar no histórico.
+    """
+    # Cenários ordenados pelo custo antes de montar a tabela, que já é construída
+    # na ordem de exibição, uma linha por registro
+    ranking = sorted(costs, key=lambda scenario: costs[scenario]["Custo final"])
+    df = pd.DataFrame([costs[scenario] for scenario in ranking], index=ranking)
+    df_display = format_brl_frame(df)
+    st.write("### Comparação por filial única")
+    st.dataframe(df_display)
+    best_scenario = ranking[0]
+    best_cost = costs[best_scenario]["Custo final"]
+    st.write(f"O melhor cenário para {filial_selected} é **{best_scenario}** com custo final de **R$ {format_brl(best_cost)}**.")
+    
+    chart_spec = build_cost_chart(tuple(ranking), tuple(costs[scenario]["Custo final"] for scenario in ranking))
+    st.vega_lite_chart(chart_spec, use_container_width=True)
+    
+    if st.button("Salvar Simulação no Histórico"):
+        simulation_record = {
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "filial": filial_selected,
+            **simulation_inputs,
+            "best_scenario": best_scenario,
+            "best_cost": best_cost,
+            "results": costs,
+            "multi_comparison": False,
+            "final_cost_com_impostos": best_cost
+        }
+        quantidade = simulation_inputs["quantidade"]
+        if quantidade > 0:
+            simulation_record["custo_unitario_melhor"] = best_cost / quantidade
+        append_history(simulation_record)
+        st.success("Simulação salva no histórico com sucesso!")
+
+@fragment
+def render_multi_results(multi_costs: Dict[Any, Any], filiais_multi: List[str], simulation_inputs: Dict[str, Any]) -> None:
+    """
+    Exibe a comparação global entre filiais e permite salvá-la no histórico.
+    
+    Args:
+        multi_costs (dict): Custos calculados por (filial, cenário).
+        filiais_multi (list): Filiais selecionadas para a comparação.
+        simulation_inputs (dict): Parâmetros da simulação a registrar no histórico.
+    """
+    ranking = sorted(multi_costs, key=lambda key: multi_costs[key]["Custo final"])
+    df_multi = pd.DataFrame([multi_costs[key] for key in ranking], index=ranking)
+    df_display = format_brl_frame(df_multi)
+    st.write("### Comparação global (multifilial)")
+    st.dataframe(df_display)
+    best_row = multi_costs[ranking[0]]
+    best_filial = best_row["Filial"]
+    best_scenario = best_row["Cenário"]
+    best_cost = best_row["Custo final"]
+    st.write(f"O melhor cenário geral é **{best_scenario}** da filial **{best_filial}** com custo final de **R$ {format_brl(best_cost)}**.")
+    if st.button("Salvar comparação no histórico"):
+        # Os registros já calculados vão direto para o histórico, na ordem da tabela,
+        # sem reconverter o DataFrame em dicionários
+        results = {" | ".join(key): multi_costs[key] for key in ranking}
+        simulation_record = {
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "multi_comparison": True,
+            "filiais_multi": filiais_multi,
+            **simulation_inputs,
+            "best_filial": best_filial,
+            "best_scenario": best_scenario,
+            "best_cost": best_cost,
+            "results": results,
+            "final_cost_com_impostos": best_cost
+        }
+        append_history(simulation_record)
+        st.success("Comparação multifilial salva no histórico com sucesso!")
+
+# -----------------------------
+# Abas do Gerenciamento
+# -----------------------------
+@fragment
+def render_cost_fields_tab(config_data: Dict[str, Any]) -> None:
+    """
+    Aba de edição dos campos de custo de um cenário.
+    
+    Como fragmento, trocar a filial, o cenário ou a página de campos reexecuta
+    apenas esta aba, e não o script inteiro com as demais abas do Gerenciamento.
+    
+    Args:
+        config_data (dict): Configuração de filiais, cenários e campos.
+    """
+    st.subheader("Gerenciamento de Campos de Custo")
+    if not config_data:
+        st.warning("Nenhuma filial cadastrada. Adicione uma filial primeiro.")
+    else:
+        filial_for_field = st.selectbox("Selecione a filial", list(config_data), key="gerenciamento_filial")
+        if not config_data[filial_for_field]:
+            st.info("Nenhum cenário cadastrado para essa filial. Adicione um cenário primeiro.")
+        else:
+            scenario_for_field = st.selectbox("Selecione o Cenário", list(config_data[filial_for_field]), key="gerenciamento_cenario")
+            scenario_fields = config_data[filial_for_field][scenario_for_field]
+            st.markdown("### Campos existentes:")
+            if scenario_fields:
+                # Todos os campos em um único formulário: as edições só provocam rerun
+                # e gravação quando o usuário envia. Como o tipo também é escolhido
+                # dentro do formulário, os widgets de valor fixo e de taxa/base ficam
+                # sempre visíveis e o tipo escolhido define quais são usados.
+                # Cenários com muitos campos são editados por página: só os widgets
+                # da página atual são montados a cada rerun
+                field_names = list(scenario_fields)
+                page_count = (len(field_names) + FIELDS_PAGE_SIZE - 1) // FIELDS_PAGE_SIZE
+                page_key = f"pagina_campos_{filial_for_field}_{scenario_for_field}"
+                # Após remoções a página guardada pode não existir mais: volta para a última
+                if st.session_state.get(page_key, 1) > page_count:
+                    st.session_state[page_key] = page_count
+                if page_count > 1:
+                    field_page = st.number_input("Página de campos", min_value=1, max_value=page_count,
+                                                 step=1, key=page_key)
+                else:
+                    field_page = 1
+                page_start = (field_page - 1) * FIELDS_PAGE_SIZE
+                with st.form(f"form_campos_{filial_for_field}_{scenario_for_field}"):
+                    edits = []
+                    for field in field_names[page_start:page_start + FIELDS_PAGE_SIZE]:
+                        current = scenario_fields[field]
+                        # Sufixo comum às chaves de todos os widgets do campo
+                        field_key = f"{filial_for_field}_{scenario_for_field}_{field}"
+                        # Campos já normalizados na carga (normalize_cost_config): sempre dicionários completos
+                        current_type = current["type"]
+                        current_fixed = float(current["value"]) if current_type == "fixed" else 0.0
+                        current_rate = float(current["rate"]) if current_type == "percentage" else 0.0
+                        current_base = current["base"] if current_type == "percentage" else "Valor CIF"
+                        current_rate_occ = bool(current["rate_by_occupancy"])
+                        # Estado atual nas mesmas unidades dos widgets (taxa em %), para comparar
+                        # com uma tupla em vez de montar e comparar dicionários
+                        if current_type == "fixed":
+                            current_key = (current_type, current_fixed, current_rate_occ)
+                        else:
+                            current_key = (current_type, current_rate * 100, current_base, current_rate_occ)
+                        col1, col2, col3, col4, col5, col6, col7 = st.columns([2.2, 2.2, 2, 2, 2.5, 1.5, 1.5])
+                        with col1:
+                            st.write(f"**{field}**")
+                        with col2:
+                            novo_tipo = st.selectbox("Tipo", ["fixed", "percentage"],
+                                                     index=0 if current_type == "fixed" else 1,
+                                                     key=f"tipo_{field_key}")
+                        with col3:
+                            novo_valor = st.number_input("Valor Fixo", min_value=0.0,
+                                                         value=current_fixed,
+                                                         key=f"fixo_{field_key}")
+                        with col4:
+                            nova_taxa = st.number_input("Taxa (%)", min_value=0.0,
+                                                        value=current_rate * 100,
+                                                        step=0.1,
+                                                        key=f"taxa_{field_key}")
+                        with col5:
+                            nova_base = st.selectbox("Base", BASES,
+                                                     index=BASE_INDEX.get(current_base, 0),
+                                                     key=f"base_{field_key}")
+                        with col6:
+                            novo_rate_occ = st.checkbox("Ratear?", value=current_rate_occ,
+                                                        key=f"rate_occ_{field_key}")
+                        with col7:
+                            remover = st.checkbox("Remover", key=f"remover_{field_key}")
+                        edits.append((field, current_key, novo_tipo, novo_valor, nova_taxa, nova_base,
+                                      novo_rate_occ, remover))
+                    submit_campos = st.form_submit_button("Salvar alterações")
+                if submit_campos:
+                    campos_alterados = []
+                    campos_removidos = []
+                    for field, current_key, novo_tipo, novo_valor, nova_taxa, nova_base, novo_rate_occ, remover in edits:
+                        if remover:
+                            del scenario_fields[field]
+                            campos_removidos.append(field)
+                            continue
+                        if novo_tipo == "fixed":
+                            novo_key = (novo_tipo, novo_valor, novo_rate_occ)
+                        else:
+                            novo_key = (novo_tipo, nova_taxa, nova_base, novo_rate_occ)
+                        # Campo inalterado: nada é montado nem gravado
+                        if novo_key == current_key:
+                            continue
+                        if novo_tipo == "fixed":
+                            scenario_fields[field] = {"type": "fixed", "value": novo_valor,
+                                                      "rate_by_occupancy": novo_rate_occ}
+                        else:
+                            scenario_fields[field] = {"type": "percentage", "rate": nova_taxa / 100.0,
+                                                      "base": nova_base, "rate_by_occupancy": novo_rate_occ}
+                        campos_alterados.append(field)
+                    # Uma única gravação por envio do formulário
+                    if campos_alterados or campos_removidos:
+                        save_data(config_data)
+                        if campos_alterados:
+                            st.success("Campo(s) atualizado(s) com sucesso: " + ", ".join(campos_alterados))
+                        if campos_removidos:
+                            st.success("Campo(s) removido(s) com sucesso: " + ", ".join(campos_removidos))
+                            st.info("Recarregue a página para ver as alterações.")
+                    else:
+                        st.info("Nenhuma alteração para salvar.")
+            else:
+                st.info("Nenhum campo definido para este cenário.")
+            
+            st.markdown("### Adicionar Novo Campo")
+            # Atualização: formulário corrigido com submit button fixo
+            with st.form("form_novo_campo"):
+                new_field = st.text_input("Nome do Novo Campo", key="novo_campo")
+                st.markdown("Defina as opções para o novo campo:")
+                field_type = st.selectbox("Tipo do Campo", ["fixed", "percentage"], key="tipo_novo")
+                if field_type == "fixed":
+                    field_value = st.number_input("Valor Fixo", min_value=0.0, value=0.0, key="valor_novo")
+                else:
+                    field_rate = st.number_input("Taxa (%)", min_value=0.0, value=0.0, step=0.1, key="taxa_novo")
+                    base_option = st.selectbox("Base", BASES, key="base_novo")
+                rate_occ_new = st.checkbox("Ratear pela ocupação do contêiner?", value=False, key="rate_occ_new")
+                submit_novo_campo = st.form_submit_button("Adicionar Campo")
+            if submit_novo_campo:
+                new_field_stripped = new_field.strip()
+                if not new_field_stripped:
+                    st.warning("Digite um nome válido para o novo campo.")
+                else:
+                    if field_type == "fixed":
+                        new_field_config = {"type": "fixed", "value": field_value, "rate_by_occupancy": rate_occ_new}
+                    else:
+                        new_field_config = {"type": "percentage", "rate": field_rate / 100.0, "base": base_option, "rate_by_occupancy": rate_occ_new}
+                    if not add_config_entry(config_data, scenario_fields, new_field_stripped, new_field_config):
+                        st.warning("Campo já existe nesse cenário!")
+                    else:
+                        st.success("Campo adicionado com sucesso!")
+                        st.info("Recarregue a página para ver as alterações.")
+
 # -----------------------------
 # Configuração do Logo e Autenticação
 # -----------------------------
@@ -370,6 +1265,9 @@ products = load_products()
 # -----------------------------
 if module_selected == "Gerenciamento":
     st.header("Gerenciamento de Configurações")
+    # Exclusões pedidas no rerun anterior: aplicadas juntas, antes de montar as abas
+    for message in apply_pending_deletes(config_data, products):
+        st.success(message)
     management_tabs = st.tabs(["Filiais", "Cenários", "Campos de Custo", "Produtos", "Origens"])
     
     # Aba 1: Gerenciamento de Filiais
@@ -381,27 +1279,22 @@ if module_selected == "Gerenciamento":
         if submitted:
             filial_stripped = new_filial.strip()
             if filial_stripped:
-                if filial_stripped in config_data:
+                if not add_config_entry(config_data, config_data, filial_stripped, {}):
                     st.warning("Filial já existe!")
                 else:
-                    config_data[filial_stripped] = {}
-                    save_data(config_data)
                     st.success("Filial adicionada com sucesso!")
                     st.info("Recarregue a página para ver as alterações.")
             else:
                 st.warning("Digite um nome válido para a filial.")
         st.markdown("### Filiais existentes:")
         if config_data:
-            for filial in list(config_data.keys()):
-                col1, col2 = st.columns([3, 1])
-                with col1:
-                    st.write(filial)
-                with col2:
-                    if st.button("Excluir", key="delete_filial_" + filial):
-                        del config_data[filial]
-                        save_data(config_data)
-                        st.success(f"Filial '{filial}' excluída.")
-                        st.info("Recarregue a página para ver as alterações.")
+            # Lista em uma única tabela; a exclusão usa um seletor e um único botão,
+            # com o mesmo número de widgets qualquer que seja a quantidade de filiais
+            filiais = list(config_data)
+            st.dataframe(names_frame(DATA_FILE, file_mtime(DATA_FILE), "Filial"))
+            filial_to_delete = st.selectbox("Filial a excluir", filiais, key="delete_filial_select")
+            st.button("Excluir filial selecionada", key="delete_filial", on_click=queue_delete,
+                      args=("config", (filial_to_delete,), f"Filial '{filial_to_delete}' excluída."))
         else:
             st.info("Nenhuma filial cadastrada.")
     
@@ -411,20 +1304,16 @@ if module_selected == "Gerenciamento":
         if not config_data:
             st.warning("Nenhuma filial cadastrada. Adicione uma filial na aba Filiais!")
         else:
-            filial_select = st.selectbox("Selecione a filial", list(config_data.keys()), key="select_filial_for_scenario")
-            scenarios_list = list(config_data[filial_select].keys())
+            filial_select = st.selectbox("Selecione a filial", list(config_data), key="select_filial_for_scenario")
+            scenarios_list = list(config_data[filial_select])
             st.markdown("### Cenários existentes:")
             if scenarios_list:
-                for scenario in scenarios_list:
-                    col1, col2 = st.columns([3, 1])
-                    with col1:
-                        st.write(scenario)
-                    with col2:
-                        if st.button("Excluir", key="delete_scenario_" + filial_select + "_" + scenario):
-                            del config_data[filial_select][scenario]
-                            save_data(config_data)
-                            st.success(f"Cenário '{scenario}' excluído da filial '{filial_select}'.")
-                            st.info("Recarregue a página para ver as alterações.")
+                st.dataframe(names_frame(DATA_FILE, file_mtime(DATA_FILE), "Cenário", filial_select))
+                scenario_to_delete = st.selectbox("Cenário a excluir", scenarios_list,
+                                                  key=f"delete_scenario_select_{filial_select}")
+                st.button("Excluir cenário selecionado", key="delete_scenario", on_click=queue_delete,
+                          args=("config", (filial_select, scenario_to_delete),
+                                f"Cenário '{scenario_to_delete}' excluído da filial '{filial_select}'."))
             else:
                 st.info("Nenhum cenário cadastrado para essa filial.")
             with st.form("form_novo_cenario"):
@@ -433,25 +1322,10 @@ if module_selected == "Gerenciamento":
             if submit_cenario:
                 scenario_stripped = new_scenario.strip()
                 if scenario_stripped:
-                    if scenario_stripped in config_data[filial_select]:
+                    if not add_config_entry(config_data, config_data[filial_select], scenario_stripped,
+                                            copy.deepcopy(DEFAULT_SCENARIO_FIELDS)):
                         st.warning("Cenário já existe para essa filial!")
                     else:
-                        # Configuração inicial do cenário
-                        config_data[filial_select][scenario_stripped] = {
-                            "Frete rodoviário": 0,
-                            "Marinha Mercante": { 
-                                "type": "percentage",
-                                "rate": 0.08,  
-                                "base": "Frete Internacional",
-                                "rate_by_occupancy": False
-                            },    
-                            "Taxa MAPA": 0,
-                            "Taxas Porto Seco": 0,
-                            "Desova EAD": 0,
-                            "Taxa cross docking": 0,
-                            "Taxa DDC": 0
-                        }
-                        save_data(config_data)
                         st.success("Cenário adicionado com sucesso!")
                         st.info("Recarregue a página para ver as alterações.")
                 else:
@@ -459,103 +1333,8 @@ if module_selected == "Gerenciamento":
     
     # Aba 3: Gerenciamento de Campos de Custo
     with management_tabs[2]:
-        st.subheader("Gerenciamento de Campos de Custo")
-        if not config_data:
-            st.warning("Nenhuma filial cadastrada. Adicione uma filial primeiro.")
-        else:
-            filial_for_field = st.selectbox("Selecione a filial", list(config_data.keys()), key="gerenciamento_filial")
-            if not config_data[filial_for_field]:
-                st.info("Nenhum cenário cadastrado para essa filial. Adicione um cenário primeiro.")
-            else:
-                scenario_for_field = st.selectbox("Selecione o Cenário", list(config_data[filial_for_field].keys()), key="gerenciamento_cenario")
-                scenario_fields = config_data[filial_for_field][scenario_for_field]
-                st.markdown("### Campos existentes:")
-                if scenario_fields:
-                    for field in list(scenario_fields.keys()):
-                        current = scenario_fields[field]
-                        if isinstance(current, dict):
-                            current_type = current.get("type", "fixed")
-                            current_fixed = float(current.get("value", 0)) if current_type == "fixed" else 0.0
-                            current_rate = float(current.get("rate", 0)) if current_type == "percentage" else 0.0
-                            current_base = current.get("base", "Valor CIF") if current_type == "percentage" else "Valor CIF"
-                            current_rate_occ = bool(current.get("rate_by_occupancy", False))
-                        else:
-                            current_type = "fixed"
-                            current_fixed = float(current)
-                            current_rate = 0.0
-                            current_base = "Valor CIF"
-                            current_rate_occ = False
-                        col1, col2, col3, col4, col5, col6 = st.columns([2.2, 2.5, 2.5, 2.5, 2, 2])
-                        with col1:
-                            st.write(f"**{field}**")
-                        with col2:
-                            novo_tipo = st.selectbox("Tipo", ["fixed", "percentage"],
-                                                       index=0 if current_type=="fixed" else 1,
-                                                       key=f"tipo_{filial_for_field}_{scenario_for_field}_{field}")
-                        novo_config = {}
-                        if novo_tipo == "fixed":
-                            with col3:
-                                novo_valor = st.number_input("Valor Fixo", min_value=0.0,
-                                                             value=current_fixed,
-                                                             key=f"fixo_{filial_for_field}_{scenario_for_field}_{field}")
-                            novo_config = {"type": "fixed", "value": novo_valor, "rate_by_occupancy": current_rate_occ}
-                            col4.write("")
-                        else:
-                            with col3:
-                                nova_taxa = st.number_input("Taxa (%)", min_value=0.0,
-                                                            value=current_rate * 100,
-                                                            step=0.1,
-                                                            key=f"taxa_{filial_for_field}_{scenario_for_field}_{field}")
-                            with col4:
-                                nova_base = st.selectbox("Base", ["Valor CIF", "Valor FOB", "Frete Internacional"],
-                                                         index=["Valor CIF", "Valor FOB", "Frete Internacional"].index(current_base),
-                                                         key=f"base_{filial_for_field}_{scenario_for_field}_{field}")
-                            novo_config = {"type": "percentage", "rate": nova_taxa / 100.0, "base": nova_base}
-                        with col5:
-                            novo_rate_occ = st.checkbox("Ratear?", value=current_rate_occ,
-                                                        key=f"rate_occ_{filial_for_field}_{scenario_for_field}_{field}")
-                            novo_config["rate_by_occupancy"] = novo_rate_occ
-                        if novo_config != current:
-                            scenario_fields[field] = novo_config
-                            save_data(config_data)
-                            st.success(f"Campo '{field}' atualizado com sucesso!")
-                        with col6:
-                            if st.button("Remover", key=f"remover_{filial_for_field}_{scenario_for_field}_{field}"):
-                                del scenario_fields[field]
-                                save_data(config_data)
-                                st.success(f"Campo '{field}' removido com sucesso!")
-                                st.stop()
-                else:
-                    st.info("Nenhum campo definido para este cenário.")
-                
-                st.markdown("### Adicionar Novo Campo")
-                # Atualização: formulário corrigido com submit button fixo
-                with st.form("form_novo_campo"):
-                    new_field = st.text_input("Nome do Novo Campo", key="novo_campo")
-                    st.markdown("Defina as opções para o novo campo:")
-                    field_type = st.selectbox("Tipo do Campo", ["fixed", "percentage"], key="tipo_novo")
-                    if field_type == "fixed":
-                        field_value = st.number_input("Valor Fixo", min_value=0.0, value=0.0, key="valor_novo")
-                    else:
-                        field_rate = st.number_input("Taxa (%)", min_value=0.0, value=0.0, step=0.1, key="taxa_novo")
-                        base_option = st.selectbox("Base", ["Valor CIF", "Valor FOB", "Frete Internacional"], key="base_novo")
-                    rate_occ_new = st.checkbox("Ratear pela ocupação do contêiner?", value=False, key="rate_occ_new")
-                    submit_novo_campo = st.form_submit_button("Adicionar Campo")
-                if submit_novo_campo:
-                    new_field_stripped = new_field.strip()
-                    if not new_field_stripped:
-                        st.warning("Digite um nome válido para o novo campo.")
-                    elif new_field_stripped in scenario_fields:
-                        st.warning("Campo já existe nesse cenário!")
-                    else:
-                        if field_type == "fixed":
-                            scenario_fields[new_field_stripped] = {"type": "fixed", "value": field_value, "rate_by_occupancy": rate_occ_new}
-                        else:
-                            scenario_fields[new_field_stripped] = {"type": "percentage", "rate": field_rate / 100.0, "base": base_option, "rate_by_occupancy": rate_occ_new}
-                        save_data(config_data)
-                        st.success("Campo adicionado com sucesso!")
-                        st.info("Recarregue a página para ver as alterações.")
-                        
+        render_cost_fields_tab(config_data)
+    
     # Aba 4: Gerenciamento de Produtos (NCM)
     with management_tabs[3]:
         st.subheader("Gerenciamento de Produtos (NCM)")
@@ -573,62 +1352,27 @@ if module_selected == "Gerenciamento":
             ncm_input = st.text_input("NCM", value=edit_mode if edit_mode else "", key="ncm_input")
             descricao = st.text_input("Descrição", value=prod_data.get("descricao", ""), key="descricao_input")
             st.markdown("#### Alíquotas de Impostos (valores em %)")
-            st.markdown("**Imposto de Importação (II):**")
-            col_ii = st.columns(2)
-            with col_ii[0]:
-                ii_rate = st.number_input("Alíquota (%)", min_value=0.0,
-                                            value=prod_data.get("imposto_importacao", {}).get("rate", 0.0) * 100,
-                                            step=0.1, key="ii_rate")
-            with col_ii[1]:
-                ii_base = st.selectbox("Base", ["Valor CIF", "Valor FOB", "Frete Internacional"],
-                                       index=["Valor CIF", "Valor FOB", "Frete Internacional"].index(
-                                           prod_data.get("imposto_importacao", {}).get("base", "Valor CIF")
-                                       ), key="ii_base")
-            st.markdown("**IPI:**")
-            col_ipi = st.columns(2)
-            with col_ipi[0]:
-                ipi_rate = st.number_input("Alíquota (%)", min_value=0.0,
-                                             value=prod_data.get("ipi", {}).get("rate", 0.0) * 100,
-                                             step=0.1, key="ipi_rate")
-            with col_ipi[1]:
-                ipi_base = st.selectbox("Base", ["Valor CIF", "Valor FOB", "Frete Internacional"],
-                                        index=["Valor CIF", "Valor FOB", "Frete Internacional"].index(
-                                            prod_data.get("ipi", {}).get("base", "Valor CIF")
-                                        ), key="ipi_base")
-            st.markdown("**PIS:**")
-            col_pis = st.columns(2)
-            with col_pis[0]:
-                pis_rate = st.number_input("Alíquota (%)", min_value=0.0,
-                                             value=prod_data.get("pis", {}).get("rate", 0.0) * 100,
-                                             step=0.1, key="pis_rate")
-            with col_pis[1]:
-                pis_base = st.selectbox("Base", ["Valor CIF", "Valor FOB", "Frete Internacional"],
-                                        index=["Valor CIF", "Valor FOB", "Frete Internacional"].index(
-                                            prod_data.get("pis", {}).get("base", "Valor CIF")
-                                        ), key="pis_base")
-            st.markdown("**Cofins:**")
-            col_cofins = st.columns(2)
-            with col_cofins[0]:
-                cofins_rate = st.number_input("Alíquota (%)", min_value=0.0,
-                                               value=prod_data.get("cofins", {}).get("rate", 0.0) * 100,
-                                               step=0.1, key="cofins_rate")
-            with col_cofins[1]:
-                cofins_base = st.selectbox("Base", ["Valor CIF", "Valor FOB", "Frete Internacional"],
-                                           index=["Valor CIF", "Valor FOB", "Frete Internacional"].index(
-                                               prod_data.get("cofins", {}).get("base", "Valor CIF")
-                                           ), key="cofins_base")
+            # Um par alíquota/base por imposto, cada seletor montado uma única vez
+            tax_inputs = {}
+            for tax, (key_prefix, label) in PRODUCT_TAX_FIELDS.items():
+                tax_data = prod_data.get(tax, {})
+                st.markdown(f"**{label}:**")
+                col_rate, col_base = st.columns(2)
+                with col_rate:
+                    tax_rate = st.number_input("Alíquota (%)", min_value=0.0,
+                                               value=tax_data.get("rate", 0.0) * 100,
+                                               step=0.1, key=f"{key_prefix}_rate")
+                with col_base:
+                    tax_base = st.selectbox("Base", BASES,
+                                            index=BASE_INDEX.get(tax_data.get("base", "Valor CIF"), 0),
+                                            key=f"{key_prefix}_base")
+                tax_inputs[tax] = {"rate": tax_rate / 100.0, "base": tax_base}
             submit_produto = st.form_submit_button("Salvar Produto")
         if submit_produto:
             if not ncm_input.strip():
                 st.warning("Informe o NCM.")
             else:
-                product_record = {
-                    "descricao": descricao,
-                    "imposto_importacao": {"rate": ii_rate / 100.0, "base": ii_base},
-                    "ipi": {"rate": ipi_rate / 100.0, "base": ipi_base},
-                    "pis": {"rate": pis_rate / 100.0, "base": pis_base},
-                    "cofins": {"rate": cofins_rate / 100.0, "base": cofins_base}
-                }
+                product_record = {"descricao": descricao, **tax_inputs}
                 products[ncm_input.strip()] = product_record
                 save_products(products)
                 st.success("Produto salvo com sucesso!")
@@ -639,33 +1383,34 @@ if module_selected == "Gerenciamento":
         st.subheader("Produtos Cadastrados")
         search_query = st.text_input("Buscar Produto", key="search_produto")
         if products:
-            filtered_products = {ncm: prod for ncm, prod in products.items() if
-                                 search_query.lower() in ncm.lower() or search_query.lower() in prod.get("descricao", "").lower()} \
-                if search_query else products
-            if filtered_products:
-                for ncm, prod in filtered_products.items():
+            # Lista materializada uma vez: a busca e a exclusão usam a mesma cópia
+            if search_query:
+                query = search_query.lower()
+                product_items = [(ncm, prod) for ncm, prod in products.items()
+                                 if query in ncm.lower() or query in prod["descricao"].lower()]
+            else:
+                product_items = list(products.items())
+            if product_items:
+                for ncm, prod in product_items:
                     col1, col2 = st.columns([7, 3])
                     with col1:
                         product_html = f"""
                         <div style="border: 1px solid #e0e0e0; border-radius: 8px; padding: 15px; background: #fff;
                         box-shadow: 2px 2px 5px rgba(0,0,0,0.1); margin-bottom: 15px;">
                             <h4 style="margin-bottom: 10px; color: #333;">NCM: {ncm}</h4>
-                            <p style="margin: 0;"><strong>Descrição:</strong> {prod.get('descricao', 'N/A')}</p>
-                            <p style="margin: 0;"><strong>II:</strong> {prod.get('imposto_importacao', {}).get('rate', 0)*100:.2f}% (Base: {prod.get('imposto_importacao', {}).get('base', 'N/A')})</p>
-                            <p style="margin: 0;"><strong>IPI:</strong> {prod.get('ipi', {}).get('rate', 0)*100:.2f}% (Base: {prod.get('ipi', {}).get('base', 'N/A')})</p>
-                            <p style="margin: 0;"><strong>Pis:</strong> {prod.get('pis', {}).get('rate', 0)*100:.2f}% (Base: {prod.get('pis', {}).get('base', 'N/A')})</p>
-                            <p style="margin: 0;"><strong>Cofins:</strong> {prod.get('cofins', {}).get('rate', 0)*100:.2f}% (Base: {prod.get('cofins', {}).get('base', 'N/A')})</p>
+                            <p style="margin: 0;"><strong>Descrição:</strong> {prod['descricao'] or 'N/A'}</p>
+                            <p style="margin: 0;"><strong>II:</strong> {prod['imposto_importacao']['rate']*100:.2f}% (Base: {prod['imposto_importacao']['base']})</p>
+                            <p style="margin: 0;"><strong>IPI:</strong> {prod['ipi']['rate']*100:.2f}% (Base: {prod['ipi']['base']})</p>
+                            <p style="margin: 0;"><strong>Pis:</strong> {prod['pis']['rate']*100:.2f}% (Base: {prod['pis']['base']})</p>
+                            <p style="margin: 0;"><strong>Cofins:</strong> {prod['cofins']['rate']*100:.2f}% (Base: {prod['cofins']['base']})</p>
                         </div>
                         """
                         st.markdown(product_html, unsafe_allow_html=True)
                     with col2:
                         if st.button("Editar", key=f"edit_{ncm}"):
                             st.session_state.edit_product = ncm
-                        if st.button("Excluir", key=f"del_{ncm}"):
-                            del products[ncm]
-                            save_products(products)
-                            st.success(f"Produto {ncm} excluído!")
-                            st.experimental_rerun()
+                        st.button("Excluir", key=f"del_{ncm}", on_click=queue_delete,
+                                  args=("produtos", (ncm,), f"Produto {ncm} excluído!"))
             else:
                 st.info("Nenhum produto encontrado para a busca.")
         else:
@@ -694,22 +1439,18 @@ if module_selected == "Gerenciamento":
             else:
                 st.warning("Informe um nome válido para a origem.")
         st.markdown("### Origens Configuradas:")
-        for origem, values in origens_config.items():
-            col1, col2, col3, col4, col5 = st.columns([2, 2, 2, 1, 1])
+        if origens_config:
+            # Uma única tabela com as origens; editar e excluir atuam sobre a origem selecionada
+            st.dataframe(origens_frame(file_mtime(ORIGENS_CONFIG_FILE)))
+            col1, col2, col3 = st.columns([4, 1, 1])
             with col1:
-                st.write(origem)
+                origem_selecionada = st.selectbox("Origem", list(origens_config), key="origem_acao")
             with col2:
-                st.write(f"Frete Internacional: USD {values['frete_internacional_usd']}")
+                if st.button("Editar", key="editar_origem"):
+                    st.session_state.edit_origem = origem_selecionada
             with col3:
-                st.write(f"Taxas de Frete: BRL {values['taxas_frete_brl']}")
-            with col4:
-                if st.button("Editar", key=f"editar_{origem}"):
-                    st.session_state.edit_origem = origem
-            with col5:
-                if st.button("Excluir", key=f"excluir_{origem}"):
-                    del origens_config[origem]
-                    save_origens_config(origens_config)
-                    st.success(f"Origem '{origem}' excluída!")
+                st.button("Excluir", key="excluir_origem", on_click=queue_delete,
+                          args=("origens", (origem_selecionada,), f"Origem '{origem_selecionada}' excluída!"))
         if "edit_origem" in st.session_state:
             origem_to_edit = st.session_state.edit_origem
             st.markdown(f"### Editar Origem: {origem_to_edit}")
@@ -739,245 +1480,103 @@ elif module_selected == "Simulador de Cenários":
     
     # Seleção de produto
     if products:
-        options = []
-        mapping = {}
-        for ncm, prod in products.items():
-            label = f"{ncm} - {prod.get('descricao', 'Sem descrição')}"
-            options.append(label)
-            mapping[label] = ncm
-        selected_label = st.selectbox("Selecione o produto (NCM)", options)
-        product_key = mapping[selected_label]
+        # As opções são os próprios NCMs; o rótulo é montado só para exibição
+        product_key = st.selectbox("Selecione o produto (NCM)", list(products),
+                                   format_func=lambda ncm: f"{ncm} - {products[ncm].get('descricao', 'Sem descrição')}")
         product = products[product_key]
     else:
         st.info("Nenhum produto cadastrado. Cadastre um produto em 'Produtos'.")
+        product_key = None
         product = None
         
-    if sim_mode == "Simulador único":
-        if not config_data:
-            st.warning("Nenhuma filial cadastrada. Adicione filiais na aba Gerenciamento.")
-        else:
-            filial_selected = st.selectbox("Selecione a filial", list(config_data.keys()))
-            with st.form("form_simulacao_unica"):
-                modo_valor_fob = st.selectbox("Como deseja informar o Valor FOB?", ["Valor total", "Unitário × Quantidade"], key="modo_valor_fob")
-                col1, col2 = st.columns(2)
-                if modo_valor_fob == "Valor total":
-                    with col1:
-                        valor_fob_usd = st.number_input("Valor FOB da mercadoria (USD)", min_value=0.0, value=0.0, key="valor_fob_usd")
-                        quantidade = 1.0
-                        valor_unit_fob_usd = 0.0
-                    with col2:
-                        st.write("Usando frete internacional configurado via origem")
-                else:
-                    with col1:
-                        valor_unit_fob_usd = st.number_input("Valor unitário FOB (USD/unidade)", min_value=0.0, value=0.0, key="valor_unit_fob_usd")
-                        quantidade = st.number_input("Quantidade", min_value=0.0, value=0.0, key="quantidade")
-                        valor_fob_usd = valor_unit_fob_usd * quantidade
-                    with col2:
-                        st.write(f"Valor FOB (USD) calculado: **{valor_fob_usd:,.2f}**")
-                
-                origens_config = load_origens_config()
-                if origens_config:
-                    origem_selecionada = st.selectbox("Selecione a origem do material", list(origens_config.keys()), key="origem_selecionada")
-                    frete_internacional_usd = origens_config[origem_selecionada]["frete_internacional_usd"]
-                    taxas_frete_brl = origens_config[origem_selecionada]["taxas_frete_brl"]
-                else:
-                    st.info("Nenhuma origem configurada. Por favor, solicite ao administrador.")
-                    frete_internacional_usd = 0.0
-                    taxas_frete_brl = 0.0
-                
-                percentual_ocupacao = st.number_input("Percentual de ocupação do contêiner (%)", min_value=0.0, max_value=100.0, value=100.0, key="percentual_ocupacao")
-                occupancy_fraction = percentual_ocupacao / 100.0
-                frete_internacional_rateado = frete_internacional_usd * occupancy_fraction
-                taxas_frete_rateada = taxas_frete_brl * occupancy_fraction
-                taxa_cambio = st.number_input("Taxa de Câmbio (USD -> BRL)", min_value=0.0, value=5.0, key="taxa_cambio")
-                valor_cif_base = (valor_fob_usd + frete_internacional_rateado) * taxa_cambio
-                seguro = 0.0015 * (valor_fob_usd * taxa_cambio)
-                valor_cif = valor_cif_base + seguro
-                base_values = {
-                    "Valor CIF": valor_cif,
-                    "Valor FOB": valor_fob_usd,
-                    "Frete Internacional": frete_internacional_rateado,
-                    "Quantidade": quantidade
-                }
-                submit_sim_unica = st.form_submit_button("Calcular Simulação")
-            
-            if submit_sim_unica:
-                if product:
-                    product_taxes = calculate_product_taxes(product, base_values, taxa_cambio, occupancy_fraction)
-                else:
-                    product_taxes = {"imposto_importacao": 0, "ipi": 0, "pis": 0, "cofins": 0}
-                costs = compute_simulation_costs(config_data, filial_selected, base_values, taxa_cambio, occupancy_fraction, taxas_frete_rateada, product_taxes)
-                if costs:
-                    df = pd.DataFrame(costs).T.sort_values(by="Custo final")
-                    df_display = df.applymap(lambda x: format_brl(x) if isinstance(x, (int, float)) else x)
-                    st.write("### Comparação por filial única")
-                    st.dataframe(df_display)
-                    best_scenario = df.index[0]
-                    best_cost = df.iloc[0]['Custo final']
-                    st.write(f"O melhor cenário para {filial_selected} é **{best_scenario}** com custo final de **R$ {format_brl(best_cost)}**.")
-                    
-                    df_reset = df.reset_index().rename(columns={"index": "Cenário"})
-                    chart = alt.Chart(df_reset).mark_bar().encode(
-                        x=alt.X("Cenário:N", sort=None),
-                        y=alt.Y("Custo final:Q", title="Custo Final (BRL)"),
-                        tooltip=["Cenário", "Custo final"]
-                    ).properties(title="Comparação de Custos por Cenário")
-                    st.altair_chart(chart, use_container_width=True)
-                    
-                    if st.button("Salvar Simulação no Histórico"):
-                        history = load_history()
-                        simulation_record = {
-                            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                            "processo_nome": processo_nome,
-                            "filial": filial_selected,
-                            "modo_valor_fob": modo_valor_fob,
-                            "valor_unit_fob_usd": valor_unit_fob_usd,
-                            "quantidade": float(quantidade),
-                            "valor_fob_usd": valor_fob_usd,
-                            "frete_internacional_usd": frete_internacional_usd,
-                            "percentual_ocupacao": percentual_ocupacao,
-                            "frete_internacional_rateado": frete_internacional_rateado,
-                            "taxas_frete_brl": taxas_frete_brl,
-                            "taxas_frete_rateada": taxas_frete_rateada,
-                            "taxa_cambio": taxa_cambio,
-                            "seguro": float(seguro),
-                            "valor_cif": valor_cif,
-                            "best_scenario": best_scenario,
-                            "best_cost": best_cost,
-                            "results": costs,
-                            "multi_comparison": False,
-                            "final_cost_com_impostos": best_cost,
-                            "produto": {"ncm": product_key, "descricao": product.get("descricao", "")} if product else {}
-                        }
-                        if quantidade > 0:
-                            simulation_record["custo_unitario_melhor"] = best_cost / quantidade
-                        history.append(simulation_record)
-                        save_history(history)
-                        st.success("Simulação salva no histórico com sucesso!")
-                else:
-                    st.warning("Nenhuma configuração encontrada para a filial selecionada.")
-                    
-    else:
+    multi = sim_mode == "Comparação multifilial"
+    if multi:
         st.subheader("Comparação multifilial")
-        if not config_data:
-            st.warning("Nenhuma filial cadastrada. Adicione filiais na aba Gerenciamento.")
+    if not config_data:
+        st.warning("Nenhuma filial cadastrada. Adicione filiais na aba Gerenciamento.")
+    elif not any(config_data.values()):
+        # Sem cenários em nenhuma filial não há o que simular: o formulário nem é montado
+        st.warning("Nenhum cenário cadastrado em nenhuma filial. Adicione cenários na aba Gerenciamento.")
+    else:
+        filiais_cadastradas = list(config_data)
+        if multi:
+            filiais_selecionadas = st.multiselect("Selecione as Filiais para comparar", filiais_cadastradas)
         else:
-            filiais_multi = st.multiselect("Selecione as Filiais para comparar", list(config_data.keys()))
-            if filiais_multi:
-                with st.form("form_simulacao_multi"):
-                    modo_valor_fob = st.selectbox("Como deseja informar o Valor FOB?", ["Valor total", "Unitário × Quantidade"], key="modo_valor_fob_multi")
-                    col1, col2 = st.columns(2)
-                    if modo_valor_fob == "Valor total":
-                        with col1:
-                            valor_fob_usd = st.number_input("Valor FOB da mercadoria (USD)", min_value=0.0, value=0.0, key="valor_fob_usd_multi")
-                            quantidade = 1.0
-                            valor_unit_fob_usd = 0.0
-                        with col2:
-                            st.write("Usando frete internacional configurado via origem")
-                    else:
-                        with col1:
-                            valor_unit_fob_usd = st.number_input("Valor Unitário FOB (USD/unidade)", min_value=0.0, value=0.0, key="valor_unit_fob_usd_multi")
-                            quantidade = st.number_input("Quantidade", min_value=0.0, value=0.0, key="quantidade_multi")
-                            valor_fob_usd = valor_unit_fob_usd * quantidade
-                        with col2:
-                            st.write(f"Valor FOB (USD) calculado: **{valor_fob_usd:,.2f}**")
-                    
-                    origens_config = load_origens_config()
-                    if origens_config:
-                        origem_selecionada = st.selectbox("Selecione a Origem do Material", list(origens_config.keys()), key="origem_selecionada_multi")
-                        frete_internacional_usd = origens_config[origem_selecionada]["frete_internacional_usd"]
-                        taxas_frete_brl = origens_config[origem_selecionada]["taxas_frete_brl"]
-                    else:
-                        st.info("Nenhuma origem configurada. Por favor, solicite ao administrador.")
-                        frete_internacional_usd = 0.0
-                        taxas_frete_brl = 0.0
-                    
-                    percentual_ocupacao = st.number_input("Percentual de Ocupação do Contêiner (%)", min_value=0.0, max_value=100.0, value=100.0, key="percentual_ocupacao_multi")
-                    occupancy_fraction = percentual_ocupacao / 100.0
-                    frete_internacional_rateado = frete_internacional_usd * occupancy_fraction
-                    taxas_frete_rateada = taxas_frete_brl * occupancy_fraction
-                    taxa_cambio = st.number_input("Taxa de Câmbio (USD -> BRL)", min_value=0.0, value=5.0, key="taxa_cambio_multi")
-                    valor_cif_base = (valor_fob_usd + frete_internacional_rateado) * taxa_cambio
-                    seguro = 0.0015 * (valor_fob_usd * taxa_cambio)
-                    valor_cif = valor_cif_base + seguro
-                    base_values = {
-                        "Valor CIF": valor_cif,
-                        "Valor FOB": valor_fob_usd,
-                        "Frete Internacional": frete_internacional_rateado,
-                        "Quantidade": quantidade
-                    }
-                    submit_sim_multi = st.form_submit_button("Calcular Comparação")
-                if submit_sim_multi:
-                    if product:
-                        product_taxes = calculate_product_taxes(product, base_values, taxa_cambio, occupancy_fraction)
-                    else:
-                        product_taxes = {"imposto_importacao": 0, "ipi": 0, "pis": 0, "cofins": 0}
+            filiais_selecionadas = [st.selectbox("Selecione a filial", filiais_cadastradas)]
+        if filiais_selecionadas:
+            submitted, form_inputs, base_values = render_simulation_form(multi)
+            # Parâmetros da última simulação calculada: enquanto não mudarem, os resultados
+            # continuam na tela nos reruns causados por widgets fora do formulário
+            current_inputs = (tuple(filiais_selecionadas), form_inputs, product_key)
+            last_inputs_key = "last_inputs_multi" if multi else "last_inputs"
+            if submitted:
+                st.session_state[last_inputs_key] = current_inputs
+            if submitted or st.session_state.get(last_inputs_key) == current_inputs:
+                simulation_inputs = {
+                    "processo_nome": processo_nome,
+                    **form_inputs,
+                    "produto": {"ncm": product_key, "descricao": product.get("descricao", "")} if product else {}
+                }
+                filiais_costs = compute_filiais_costs(config_data, filiais_selecionadas, base_values,
+                                                      form_inputs["taxa_cambio"],
+                                                      form_inputs["percentual_ocupacao"] / 100.0,
+                                                      form_inputs["taxas_frete_rateada"], product)
+                if multi:
                     multi_costs = {}
-                    for filial in filiais_multi:
-                        if filial not in config_data:
-                            continue
-                        filial_costs = compute_simulation_costs(config_data, filial, base_values, taxa_cambio, occupancy_fraction, taxas_frete_rateada, product_taxes)
+                    for filial, filial_costs in filiais_costs.items():
                         for scenario, result in filial_costs.items():
-                            key = (filial, scenario)
                             result["Filial"] = filial
                             result["Cenário"] = scenario
-                            multi_costs[key] = result
+                            multi_costs[(filial, scenario)] = result
                     if multi_costs:
-                        df_multi = pd.DataFrame(multi_costs).T.sort_values(by="Custo final")
-                        df_display = df_multi.applymap(lambda x: format_brl(x) if isinstance(x, (int, float)) else x)
-                        st.write("### Comparação global (multifilial)")
-                        st.dataframe(df_display)
-                        best_row = df_multi.iloc[0]
-                        best_filial = best_row["Filial"]
-                        best_scenario = best_row["Cenário"]
-                        best_cost = best_row["Custo final"]
-                        st.write(f"O melhor cenário geral é **{best_scenario}** da filial **{best_filial}** com custo final de **R$ {format_brl(best_cost)}**.")
-                        if st.button("Salvar comparação no histórico"):
-                            history = load_history()
-                            simulation_record = {
-                                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                "processo_nome": processo_nome,
-                                "multi_comparison": True,
-                                "filiais_multi": filiais_multi,
-                                "modo_valor_fob": modo_valor_fob,
-                                "valor_unit_fob_usd": valor_unit_fob_usd,
-                                "quantidade": float(quantidade),
-                                "valor_fob_usd": valor_fob_usd,
-                                "frete_internacional_usd": frete_internacional_usd,
-                                "percentual_ocupacao": percentual_ocupacao,
-                                "frete_internacional_rateado": frete_internacional_rateado,
-                                "taxas_frete_brl": taxas_frete_brl,
-                                "taxas_frete_rateada": taxas_frete_rateada,
-                                "taxa_cambio": taxa_cambio,
-                                "seguro": float(seguro),
-                                "valor_cif": valor_cif,
-                                "best_filial": best_filial,
-                                "best_scenario": best_scenario,
-                                "best_cost": best_cost,
-                                "results": {},
-                                "final_cost_com_impostos": best_cost,
-                                "produto": {"ncm": product_key, "descricao": product.get("descricao", "")} if product else {}
-                            }
-                            df_multi.index = df_multi.index.map(lambda x: " | ".join(map(str, x)) if isinstance(x, tuple) else str(x))
-                            simulation_record["results"] = df_multi.to_dict(orient="index")
-                            history.append(simulation_record)
-                            save_history(history)
-                            st.success("Comparação multifilial salva no histórico com sucesso!")
+                        render_multi_results(multi_costs, filiais_selecionadas, simulation_inputs)
                     else:
                         st.warning("Nenhuma configuração encontrada para as filiais selecionadas.")
-            else:
-                st.info("Selecione pelo menos uma filial para comparar.")
+                else:
+                    filial_selected = filiais_selecionadas[0]
+                    costs = filiais_costs.get(filial_selected, {})
+                    if costs:
+                        render_single_results(costs, filial_selected, simulation_inputs)
+                    else:
+                        st.warning("Nenhuma configuração encontrada para a filial selecionada.")
+        else:
+            st.info("Selecione pelo menos uma filial para comparar.")
 
 # -----------------------------
 # MÓDULO: HISTÓRICO DE SIMULAÇÕES
 # -----------------------------
 elif module_selected == "Histórico de Simulações":
     st.header("Histórico de Simulações")
-    history = load_history()
-    if history:
-        sorted_history = sorted(history, key=lambda r: datetime.strptime(r["timestamp"], "%Y-%m-%d %H:%M:%S"), reverse=True)
+    if st.session_state.pop("_history_deleted", False):
+        st.success("Registro excluído com sucesso!")
+    sorted_history = load_sorted_history()
+    if sorted_history:
         st.markdown("### Registros de Simulação")
-        for record in sorted_history:
+        # Apenas a página selecionada é montada; o arquivo completo fica no download
+        total_records = len(sorted_history)
+        col_page_size, col_page, col_download = st.columns([1, 1, 2])
+        with col_page_size:
+            page_size = st.selectbox("Registros por página", HISTORY_PAGE_SIZES, key="history_page_size",
+                                     on_change=clamp_history_page, args=(total_records,))
+        with col_page:
+            page_count = (total_records + page_size - 1) // page_size
+            # Sem value explícito: a página inicial é min_value e o valor pode ser ajustado
+            # pelo session_state (clamp_history_page) sem conflito com um valor padrão
+            page = st.number_input("Página", min_value=1, max_value=page_count, step=1, key="history_page")
+        with col_download:
+            try:
+                stat = os.stat(HISTORY_FILE)
+            except FileNotFoundError:
+                stat = None
+            if stat is not None:
+                # Bytes em cache por versão do arquivo: o download não relê o histórico a cada rerun
+                history_bytes = read_file_bytes(HISTORY_FILE, stat.st_size, stat.st_mtime_ns)
+                st.download_button("Baixar histórico completo", data=history_bytes,
+                                   file_name=HISTORY_FILE, mime="application/x-ndjson")
+        start = (page - 1) * page_size
+        page_records = sorted_history[start:start + page_size]
+        st.caption(f"Exibindo {start + 1}–{start + len(page_records)} de {total_records} registros")
+        for record in page_records:
             expander_title = f"{record['timestamp']}"
             if "best_scenario" in record:
                 expander_title += f" | Melhor: {record['best_scenario']}"
@@ -988,38 +1587,37 @@ elif module_selected == "Histórico de Simulações":
             else:
                 expander_title += f" | Filial: {record.get('filial', 'N/A')}"
             with st.expander(expander_title):
-                st.write(f"**Processo:** {record.get('processo_nome', 'N/A')}")
-                st.write(f"**Data/Hora:** {record['timestamp']}")
+                # Resumo do registro em um único elemento markdown (uma linha por item)
+                summary = [
+                    f"**Processo:** {record.get('processo_nome', 'N/A')}",
+                    f"**Data/Hora:** {record['timestamp']}"
+                ]
                 if record.get("multi_comparison", False):
                     filiais = record.get("filiais_multi", [])
                     if filiais:
-                        st.write("**Filiais Selecionadas:** " + ", ".join(filiais))
-                    st.write("**Melhor filial:**", record.get("best_filial", "N/A"))
-                    st.write("**Melhor cenário:**", record.get("best_scenario", "N/A"))
-                    st.write("**Custo final:** R$", format_brl(record.get("best_cost", 0.0)))
-                    st.write("**Valor CIF com seguro:** R$", format_brl(record.get("valor_cif", 0.0)))
-                    
-                    results_dict = record.get("results", {})
-                    if results_dict:
-                        results_df = pd.DataFrame.from_dict(results_dict, orient="index")
-                        results_df_display = results_df.applymap(lambda x: format_brl(x) if isinstance(x, (int, float)) else x)
-                        st.dataframe(results_df_display)
-                
+                        summary.append("**Filiais Selecionadas:** " + ", ".join(filiais))
+                    summary += [
+                        f"**Melhor filial:** {record.get('best_filial', 'N/A')}",
+                        f"**Melhor cenário:** {record.get('best_scenario', 'N/A')}",
+                        f"**Custo final:** R$ {format_brl(record.get('best_cost', 0.0))}",
+                        f"**Valor CIF com seguro:** R$ {format_brl(record.get('valor_cif', 0.0))}"
+                    ]
                 else:
-                    st.write(f"**Filial:** {record.get('filial', 'N/A')}")
-                    st.write(f"**Melhor cenário:** {record.get('best_scenario', 'N/A')}")
-                    st.write(f"**Custo final:** R$ {format_brl(record.get('best_cost', 0.0))}")
-                    st.write("**Valor FOB:** R$ ", format_brl(record.get("valor_fob_usd", 0.0)))
-                    st.write("**Valor CIF com seguro:** R$ ", format_brl(record.get("valor_cif", 0.0)))
-                    results_dict = record.get("results", {})
-                    if results_dict:
-                        results_df = pd.DataFrame(results_dict).T
-                        results_df_display = results_df.applymap(lambda x: format_brl(x) if isinstance(x, (int, float)) else x)
-                        st.dataframe(results_df_display)
+                    summary += [
+                        f"**Filial:** {record.get('filial', 'N/A')}",
+                        f"**Melhor cenário:** {record.get('best_scenario', 'N/A')}",
+                        f"**Custo final:** R$ {format_brl(record.get('best_cost', 0.0))}",
+                        f"**Valor FOB:** R$ {format_brl(record.get('valor_fob_usd', 0.0))}",
+                        f"**Valor CIF com seguro:** R$ {format_brl(record.get('valor_cif', 0.0))}"
+                    ]
+                st.markdown("  \n".join(summary))
+                results_dict = record.get("results", {})
+                if results_dict:
+                    results_df = pd.DataFrame.from_dict(results_dict, orient="index")
+                    results_df_display = format_brl_frame(results_df)
+                    st.dataframe(results_df_display)
                 
-                if st.button("Excluir este registro", key=f"delete_{record['timestamp']}"):
-                    sorted_history.remove(record)
-                    save_history(sorted_history)
-                    st.success("Registro excluído com sucesso!")
+                st.button("Excluir este registro", key=f"delete_{record['id']}",
+                          on_click=delete_history_record, args=(record["id"],))
     else:
         st.info("Nenhuma simulação registrada no histórico.")